@@ -19,6 +19,7 @@
 
 from __future__ import annotations
 
+import functools
 import os
 import shutil
 import subprocess
@@ -41,14 +42,15 @@ def compile_c_file(
 
     Returns the compiler's standard output/error.
     """
-    if _lcc is None:
+    lcc, lcc_dir = _locate_lcc()
+    if lcc is None:
         raise FileNotFoundError(
             "Unable to locate lcc. Set the LCC environment variable or make sure "
             "it is in your PATH."
         )
 
     command = [
-        _lcc,
+        lcc,
         "-DQ3_VM",
         "-S",
         "-Wf-target=bytecode",
@@ -60,9 +62,7 @@ def compile_c_file(
 
     # make sure lcc can find the other executables it needs
     env = os.environ.copy()
-    env["PATH"] = (
-        os.path.realpath(os.path.dirname(_lcc)) + os.pathsep + env.get("PATH", "")
-    )
+    env["PATH"] = lcc_dir + os.pathsep + env.get("PATH", "")
 
     try:
         output = subprocess.check_output(command, env=env, stderr=subprocess.STDOUT)
@@ -90,4 +90,14 @@ def _find_lcc():
     )
 
 
-_lcc = _find_lcc()
+@functools.lru_cache(maxsize=None)
+def _locate_lcc():
+    """Return lcc's path and the real path of its directory, or (None, None).
+
+    The search is done the first time lcc is needed and then reused, so importing
+    quatch doesn't probe PATH and compiles don't repeat it.
+    """
+    lcc = _find_lcc()
+    if lcc is None:
+        return None, None
+    return lcc, os.path.realpath(os.path.dirname(lcc))
@@ -20,7 +20,6 @@
 from __future__ import annotations
 
 import enum
-import io
 import struct
 from collections.abc import Iterable
 from itertools import islice
@@ -109,6 +108,21 @@ operand_sizes = {
 operand_sizes.update({op: 4 for op in islice(Opcode, Opcode.EQ, Opcode.GEF + 1)})
 operand_sizes.update({op: 0 for op in Opcode if op not in operand_sizes})
 
+# operand_sizes as a tuple indexed by opcode value, for use in hot loops
+_operand_size_table = tuple(operand_sizes[op] for op in sorted(Opcode))
+
+# operand sizes as a bytes.translate table, for measuring code without decoding it
+_operand_size_bytes = bytes(_operand_size_table).ljust(256, b"\0")
+
+# functions for packing an opcode together with its operand, and masks that give the
+# two's complement encoding of negative operands, both indexed by opcode value
+_integer_formats = {1: struct.Struct("<BB"), 4: struct.Struct("<BI")}
+_operand_packers = tuple(
+    _integer_formats[size].pack if size else None for size in _operand_size_table
+)
+_operand_masks = tuple((1 << size * 8) - 1 for size in _operand_size_table)
+_float_pack = struct.Struct("<Bf").pack
+
 
 class Instruction:
     """A qvm instruction.
@@ -134,6 +148,8 @@ class Instruction:
         Instruction(Opcode.CONST, 0x7b)
     """
 
+    __slots__ = ("_opcode", "_operand")
+
     def __init__(self, opcode: Opcode, operand: Optional[Operand] = None) -> None:
         """Initialize an Instruction from an opcode and operand."""
         self._opcode: Opcode = opcode
@@ -141,7 +157,7 @@ class Instruction:
 
         if operand is not None:
             self.operand = operand
-        elif operand_sizes[opcode] != 0:
+        elif _operand_size_table[opcode] != 0:
             raise TypeError(f"{opcode.name} requires an operand")
 
     def __repr__(self) -> str:
@@ -172,7 +188,7 @@ class Instruction:
 
     @operand.setter
     def operand(self, value: Operand) -> None:
-        size = operand_sizes[self._opcode]
+        size = _operand_size_table[self._opcode]
         if size == 0:
             raise TypeError(f"{self._opcode.name} does not take an operand")
 
@@ -204,14 +220,7 @@ class Instruction:
             >>> Instruction(Opcode.CONST, 123).assemble()
             b'\x08{\x00\x00\x00'
         """
-        code = self._opcode.to_bytes(1, "little")
-        if isinstance(self._operand, float):
-            code += struct.pack("<f", self._operand)
-        elif self._operand is not None:
-            code += self._operand.to_bytes(
-                operand_sizes[self._opcode], "little", signed=self._operand < 0
-            )
-        return code
+        return bytes(assemble([self]))
 
 
 def assemble(instructions: Iterable[Instruction]) -> bytes:
@@ -224,9 +233,31 @@ def assemble(instructions: Iterable[Instruction]) -> bytes:
         >>> assemble([Ins(Op.PUSH), Ins(Op.CONST, 123)])
         bytearray(b'\x06\x08{\x00\x00\x00')
     """
+    pairs = (
+        (instruction._opcode, instruction._operand) for instruction in instructions
+    )
+    return _encode(pairs)
+
+
+def encode(opcodes: Iterable[int], operands: Iterable[Optional[Operand]]) -> bytearray:
+    """Encode parallel arrays of opcode values and operands into bytes.
+
+    This is the inverse of decode.
+    """
+    return _encode(zip(opcodes, operands))
+
+
+def _encode(pairs: Iterable[tuple[int, Optional[Operand]]]) -> bytearray:
     code = bytearray()
-    for instruction in instructions:
-        code += instruction.assemble()
+    append = code.append
+    extend = code.extend
+    for opcode, operand in pairs:
+        if operand is None:
+            append(opcode)
+        elif isinstance(operand, float):
+            extend(_float_pack(opcode, operand))
+        else:
+            extend(_operand_packers[opcode](opcode, operand & _operand_masks[opcode]))
     return code
 
 
@@ -239,20 +270,58 @@ def disassemble(code: bytes) -> list[Instruction]:
         >>> disassemble(b'\x06\x08\x7b\x00\x00\x00')
         [Instruction(Opcode.PUSH), Instruction(Opcode.CONST, 0x7b)]
     """
-    stream = io.BytesIO(code)
-    instructions = []
+    return instructions_from_arrays(*decode(code))
 
-    while True:
-        byte = stream.read(1)
-        if byte == b"":
+
+def decode(
+    code: bytes, count: Optional[int] = None
+) -> tuple[bytearray, list[Optional[int]]]:
+    """Decode bytes into parallel arrays of opcode values and operands.
+
+    Instructions without an operand have None in the operands list. If count is
+    given, decoding stops after that many instructions.
+    """
+    opcodes = bytearray()
+    operands: list[Optional[int]] = []
+    position = 0
+
+    # there can't be more instructions than bytes
+    if count is None:
+        count = len(code)
+
+    for _ in range(count):
+        if position >= len(code):
             break
 
-        opcode = Opcode(int.from_bytes(byte, "little"))
+        opcode = code[position]
+        position += 1
 
-        if operand_sizes[opcode] != 0:
-            operand = int.from_bytes(stream.read(operand_sizes[opcode]), "little")
-            instructions.append(Instruction(opcode, operand))
+        try:
+            size = _operand_size_table[opcode]
+        except IndexError:
+            raise ValueError(f"{opcode} is not a valid Opcode") from None
+
+        opcodes.append(opcode)
+        if size != 0:
+            operand = int.from_bytes(code[position : position + size], "little")
+            operands.append(operand)
+            position += size
         else:
-            instructions.append(Instruction(opcode))
+            operands.append(None)
+
+    return opcodes, operands
+
+
+def encoded_size(opcodes: bytes) -> int:
+    """Return the number of bytes taken up by instructions with the given opcodes."""
+    return len(opcodes) + sum(opcodes.translate(_operand_size_bytes))
+
 
-    return instructions
+def instructions_from_arrays(
+    opcodes: Iterable[int], operands: Iterable[Optional[Operand]]
+) -> list[Instruction]:
+    """Create Instructions from parallel arrays of opcode values and operands."""
+    return [
+        Instruction(Opcode(opcode), operand)
+        for opcode, operand in zip(opcodes, operands)
+    ]
@@ -39,6 +39,14 @@ class Memory:
         self._regions: list[Region] = []
         self._size = 0
 
+        # the bounds of each region, so they can be searched with bisect without
+        # calling Region's comparison methods
+        self._begins: list[int] = []
+        self._ends: list[int] = []
+
+        # the most recently found region, since accesses tend to be sequential
+        self._last_region: Optional[Region] = None
+
     @overload
     def __getitem__(self, key: int) -> int:
         ...
@@ -59,21 +67,19 @@ class Memory:
 
         elif isinstance(key, slice):
             key = self._check_slice(key)
-            result = bytearray()
-            position = key.start
-            for region in self.regions_overlapping(key.start, key.stop):
-                # gaps caused by align() should be filled with zeros
-                result.extend(b"\x00" * (region.begin - position))
-                position = region.end
 
-                begin = max(0, key.start - region.begin)
-                end = region.size - max(0, (region.end - key.stop))
+            # fast path for slices that lie entirely within a single region
+            region = self.region_at(key.start)
+            if region is not None and key.start < key.stop <= region.end:
                 if region.contents is None:
-                    result.extend(b"\x00" * (end - begin))
-                else:
-                    result.extend(region.contents[begin:end])
-
-            result.extend(b"\x00" * (key.stop - position))
+                    return bytearray(key.stop - key.start)
+                begin = key.start - region.begin
+                return region.contents[begin : begin + key.stop - key.start]
+
+            # start out zero-filled, so gaps caused by align() and BSS regions don't
+            # need to be written
+            result = bytearray(max(0, key.stop - key.start))
+            self.copy_into(result, 0, key.start, key.stop)
             return result
 
         else:
@@ -109,6 +115,17 @@ class Memory:
             if key.stop <= key.start:
                 return
 
+            # fast path for slices that lie entirely within a single region
+            region = self.region_at(key.start)
+            if (
+                region is not None
+                and key.stop <= region.end
+                and region.contents is not None
+            ):
+                begin = key.start - region.begin
+                region.contents[begin : begin + len(value)] = value
+                return
+
             regions = self.regions_overlapping(key.start, key.stop)
             writable = True
 
@@ -140,6 +157,22 @@ class Memory:
         else:
             raise TypeError("indices must be integers or slices")
 
+    def copy_into(self, buffer: bytearray, offset: int, begin: int, end: int) -> None:
+        """Copy self[begin:end] into buffer starting at offset.
+
+        Only bytes with contents are copied, so padding and BSS bytes are left as they
+        were in buffer. This avoids the temporary bytearray that slicing would create.
+        """
+        for region in self.regions_overlapping(begin, end):
+            if region.contents is not None:
+                src_begin = max(0, begin - region.begin)
+                src_end = region.size - max(0, region.end - end)
+                dest = offset + region.begin + src_begin - begin
+                with memoryview(region.contents) as contents:
+                    buffer[dest : dest + src_end - src_begin] = contents[
+                        src_begin:src_end
+                    ]
+
     def _check_index(self, key: int) -> int:
         if key < 0:
             key += len(self)
@@ -163,13 +196,18 @@ class Memory:
         *,
         data: Optional[bytes] = None,
         size: Optional[int] = None,
-        alignment: int = 1
+        alignment: int = 1,
+        copy: bool = True
     ) -> int:
         """Add a new region of memory and return its address.
 
         Exactly one of data or size must be provided. Providing size will fill the
         region with zeros.
 
+        If copy is False and data is a bytearray, it will be used as the region's
+        contents directly instead of being copied. The caller must not modify it
+        afterwards.
+
         DATA regions are meant hold to 4-byte words, so alignment and the size of data
         must both be multiples of 4 if tag is DATA.
 
@@ -188,22 +226,26 @@ class Memory:
 
         if data is not None:
             size = len(data)
-            if tag == RegionTag.BSS:
+            if tag is RegionTag.BSS:
                 if any(byte != 0 for byte in data):
                     raise ValueError("BSS bytes must be zero")
                 data = None
-            else:
+            elif copy or not isinstance(data, bytearray):
                 data = bytearray(data)
         else:
             assert size is not None
-            if tag != RegionTag.BSS:
+            if tag is not RegionTag.BSS:
                 data = bytearray(size)
 
-        if tag == RegionTag.DATA and (size % 4 != 0 or alignment % 4 != 0):
+        if tag is RegionTag.DATA and (size % 4 != 0 or alignment % 4 != 0):
             raise ValueError("DATA regions must be at least 4-byte aligned")
 
+        self._last_region = None
+
         if size != 0:
             self._regions.append(Region(self._size, self._size + size, tag, data))
+            self._begins.append(self._size)
+            self._ends.append(self._size + size)
             self._size += size
 
         return address
@@ -218,24 +260,29 @@ class Memory:
     def regions_with_tag(self, tag: RegionTag) -> Iterator[Region]:
         """Find all regions with a given tag."""
         for region in self._regions:
-            if region.tag == tag:
+            if region.tag is tag:
                 yield region
 
     def region_at(self, point: int) -> Optional[Region]:
         """Find the Region overlapping a point."""
-        regions = self.regions_overlapping(point, point + 1)
-        if len(regions) == 0:
+        region = self._last_region
+        if region is not None and region.begin <= point < region.end:
+            return region
+
+        # the first region ending after point is the only one that can contain it
+        index = bisect.bisect_right(self._ends, point)
+        if index == len(self._regions) or self._begins[index] > point:
             return None
-        assert len(regions) == 1  # we shouldn't have created any overlaps
-        return regions[0]
+        region = self._last_region = self._regions[index]
+        return region
 
     def regions_overlapping(self, begin: int, end: int) -> list[Region]:
         """Find every Region that overlaps the interval [begin, end)."""
         if end <= begin:
             return []
-        query = Region(begin, end)
-        first = max(bisect.bisect_left(self._regions, query), 0)
-        last = min(bisect.bisect_right(self._regions, query), len(self._regions))
+        # the first region ending after begin through the last one starting before end
+        first = bisect.bisect_right(self._ends, begin)
+        last = bisect.bisect_left(self._begins, end)
         return self._regions[first:last]
 
 
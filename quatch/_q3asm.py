@@ -16,8 +16,9 @@
 # You should have received a copy of the GNU General Public License
 # along with Quatch; If not, see <https://www.gnu.org/licenses/>.
 
+import re
 from ._instruction import Instruction as Ins, Opcode as Op
-from ._util import align, pad
+from ._util import align, pad_in_place
 
 opcode_map = {
     "BREAK": Op.BREAK,
@@ -117,17 +118,30 @@ opcode_map = {
     "LOADU4": Op.UNDEF,
 }
 
+# a sign followed by a number or symbol name
+expression_term_regex = re.compile(r"([+-]?)([^+-]+)")
+
 
 class Segment:
+    __slots__ = ("image", "segment_base")
+
     def __init__(self, image=None, segment_base=0):
         self.image = image or bytearray()
         self.segment_base = segment_base
 
+    def align(self, alignment):
+        pad_in_place(self.image, alignment)
+
 
 class Symbol:
+    __slots__ = ("segment", "value", "address")
+
     def __init__(self, segment, value):
         self.segment = segment
         self.value = value
+        # filled in on first lookup during the second pass, when segment bases and
+        # symbol values no longer change
+        self.address = None
 
 
 class AssemblerError(Exception):
@@ -142,6 +156,7 @@ class Assembler:
         bss = self.segments["bss"]
 
         self.symbols = {}
+        self.expression_cache = {}
 
         self.file = "unknown"
         self.line = 0
@@ -152,6 +167,15 @@ class Assembler:
         for sym, value in symbols.items():
             self.symbols[sym] = Symbol(fake_segment, value)
 
+        # both passes see the same lines, so only read and split them once
+        files = []
+        for filename in input_files:
+            with open(filename) as f:
+                lines = [line.split() for line in f]
+            files.append(
+                [tokens for tokens in lines if tokens and not tokens[0].startswith(";")]
+            )
+
         self.current_args = 0
         self.current_locals = 0
         self.current_arg_offset = 0
@@ -160,23 +184,23 @@ class Assembler:
             data.segment_base = data_base
             lit.segment_base = data_base + len(data.image)
             bss.segment_base = lit.segment_base + len(lit.image)
-            for seg in self.segments:
-                self.segments[seg].image = bytearray()
+            for segment in self.segments.values():
+                segment.image = bytearray()
 
             instructions = []
+            emit = instructions.extend
 
-            for current_file_index, filename in enumerate(input_files):
+            for current_file_index, lines in enumerate(files):
                 self.current_file_index = current_file_index
-                with open(filename) as f:
-                    for line in f:
-                        instructions.extend(
-                            self._assemble_line(
-                                line, address=code_base + len(instructions)
-                            )
-                        )
+                self.local_symbol_suffix = f"_{current_file_index}"
+                for tokens in lines:
+                    handler = line_handlers.get(tokens[0])
+                    if handler is None:
+                        handler = find_line_handler(tokens[0])
+                    emit(handler(self, tokens, code_base + len(instructions)))
 
-            for seg in self.segments:
-                self.segments[seg].image = pad(self.segments[seg].image, 4)
+            for segment in self.segments.values():
+                segment.align(4)
 
         # convert symbol values to their actual addresses
         symbols = {
@@ -186,148 +210,152 @@ class Assembler:
 
         return instructions, self.segments, symbols
 
-    def _assemble_line(self, line, address):
-        tokens = line.split()
-        if len(tokens) == 0:
+    def _assemble_opcode(self, tokens, address):
+        opcode = opcode_map[tokens[0]]
+
+        if opcode is Op.UNDEF:
+            self._error(f"undefined opcode {opcode}")
+
+        if opcode is Op.IGNORE:
             return []
 
-        if tokens[0] in opcode_map:
-            opcode = opcode_map[tokens[0]]
-
-            if opcode == Op.UNDEF:
-                self._error(f"undefined opcode {opcode}")
-
-            if opcode == Op.IGNORE:
-                return []
-
-            if opcode == Op.SEX8:
-                # sign extensions need to check next parm
-                if tokens[1][0] == "1":
-                    opcode = Op.SEX8
-                elif tokens[1][0] == "2":
-                    opcode = Op.SEX16
-                else:
-                    self._error(f"bad sign extension {tokens[1]}")
-                # get rid of the parm now that we have the right opcode
-                tokens = tokens[:1]
-
-            if len(tokens) >= 2 and opcode not in (Op.CVIF, Op.CVFI):
-                operand = self._parse_expression(tokens[1])
-                if opcode == Op.BLOCK_COPY:
-                    operand = align(operand, 4)
+        if opcode is Op.SEX8:
+            # sign extensions need to check next parm
+            if tokens[1][0] == "1":
+                opcode = Op.SEX8
+            elif tokens[1][0] == "2":
+                opcode = Op.SEX16
             else:
-                operand = None
+                self._error(f"bad sign extension {tokens[1]}")
+            # get rid of the parm now that we have the right opcode
+            tokens = tokens[:1]
+
+        if len(tokens) >= 2 and opcode is not Op.CVIF and opcode is not Op.CVFI:
+            operand = self._parse_expression(tokens[1])
+            if opcode is Op.BLOCK_COPY:
+                operand = align(operand, 4)
+        else:
+            operand = None
 
-            return [Ins(opcode, operand)]
+        return [Ins(opcode, operand)]
 
-        elif tokens[0].startswith("CALL"):
-            self.current_arg_offset = 0
-            return [Ins(Op.CALL)]
+    def _assemble_call(self, tokens, address):
+        self.current_arg_offset = 0
+        return [Ins(Op.CALL)]
 
-        elif tokens[0].startswith("ARG"):
-            self.current_arg_offset += 4
-            return [Ins(Op.ARG, 8 + self.current_arg_offset - 4)]
+    def _assemble_arg(self, tokens, address):
+        self.current_arg_offset += 4
+        return [Ins(Op.ARG, 8 + self.current_arg_offset - 4)]
 
-        elif tokens[0].startswith("RET"):
-            return [Ins(Op.LEAVE, 8 + self.current_locals + self.current_args)]
+    def _assemble_ret(self, tokens, address):
+        return [Ins(Op.LEAVE, 8 + self.current_locals + self.current_args)]
 
-        elif tokens[0].startswith("pop"):
-            return [Ins(Op.POP)]
+    def _assemble_pop(self, tokens, address):
+        return [Ins(Op.POP)]
 
-        elif tokens[0].startswith("ADDRF"):
-            offset = self._parse_expression(tokens[1])
-            offset += 16 + self.current_args + self.current_locals
-            return [Ins(Op.LOCAL, offset)]
+    def _assemble_addrf(self, tokens, address):
+        offset = self._parse_expression(tokens[1])
+        offset += 16 + self.current_args + self.current_locals
+        return [Ins(Op.LOCAL, offset)]
 
-        elif tokens[0].startswith("ADDRL"):
-            offset = self._parse_expression(tokens[1]) + 8 + self.current_args
-            return [Ins(Op.LOCAL, offset)]
+    def _assemble_addrl(self, tokens, address):
+        offset = self._parse_expression(tokens[1]) + 8 + self.current_args
+        return [Ins(Op.LOCAL, offset)]
 
-        elif tokens[0] == "proc":
-            self._define_symbol(tokens[1], address)
-            self.current_locals = align(int(tokens[2]), 4)
-            self.current_args = align(int(tokens[3]), 4)
-            return [Ins(Op.ENTER, 8 + self.current_locals + self.current_args)]
-
-        elif tokens[0] == "endproc":
-            return [
-                Ins(Op.PUSH),
-                Ins(Op.LEAVE, 8 + self.current_locals + self.current_args),
-            ]
-
-        elif tokens[0] == "address":
-            value = self._parse_expression(tokens[1])
-            self._hack_to_segment(self.segments["data"])
-            self.current_segment.image += value.to_bytes(4, "little")
-
-        elif tokens[0] in self.segments:
-            self.current_segment = self.segments[tokens[0]]
-
-        elif tokens[0] == "equ":
-            self._define_symbol(tokens[1], int(tokens[2]))
-
-        elif tokens[0] == "align":
-            alignment = int(tokens[1])
-            self.current_segment.image = pad(self.current_segment.image, alignment)
-
-        elif tokens[0] == "skip":
-            size = int(tokens[1])
-            self.current_segment.image += b"\x00" * size
-
-        elif tokens[0] == "byte":
-            size = int(tokens[1])
-            value = int(tokens[2])
-            if size == 1:
-                self._hack_to_segment(self.segments["lit"])
-            elif size == 4:
-                self._hack_to_segment(self.segments["data"])
-            self.current_segment.image += value.to_bytes(size, "little")
-
-        elif tokens[0].startswith("LABEL"):
-            if self.current_segment == self.segments["code"]:
-                self._define_symbol(tokens[1], address)
-            else:
-                self._define_symbol(tokens[1], len(self.current_segment.image))
+    def _assemble_proc(self, tokens, address):
+        self._define_symbol(tokens[1], address)
+        self.current_locals = align(int(tokens[2]), 4)
+        self.current_args = align(int(tokens[3]), 4)
+        return [Ins(Op.ENTER, 8 + self.current_locals + self.current_args)]
 
-        elif tokens[0] == "file":
-            self.file = tokens[1][1:-1]
+    def _assemble_endproc(self, tokens, address):
+        return [
+            Ins(Op.PUSH),
+            Ins(Op.LEAVE, 8 + self.current_locals + self.current_args),
+        ]
 
-        elif tokens[0] == "line":
-            self.line = int(tokens[1])
+    def _assemble_address(self, tokens, address):
+        value = self._parse_expression(tokens[1])
+        data = self.segments["data"]
+        self._hack_to_segment(data)
+        data.image += value.to_bytes(4, "little")
+        return []
+
+    def _assemble_segment(self, tokens, address):
+        self.current_segment = self.segments[tokens[0]]
+        return []
+
+    def _assemble_equ(self, tokens, address):
+        self._define_symbol(tokens[1], int(tokens[2]))
+        return []
+
+    def _assemble_align(self, tokens, address):
+        alignment = int(tokens[1])
+        self.current_segment.align(alignment)
+        return []
 
-        elif tokens[0] in ("import", "export", "line", "file"):
-            pass
+    def _assemble_skip(self, tokens, address):
+        size = int(tokens[1])
+        self.current_segment.image.extend(bytes(size))
+        return []
 
-        elif tokens[0].startswith(";"):
-            pass
+    def _assemble_byte(self, tokens, address):
+        size = int(tokens[1])
+        value = int(tokens[2])
+        segments = self.segments
+        if size == 1:
+            self._hack_to_segment(segments["lit"])
+        elif size == 4:
+            self._hack_to_segment(segments["data"])
+        self.current_segment.image += value.to_bytes(size, "little")
+        return []
 
+    def _assemble_label(self, tokens, address):
+        segment = self.current_segment
+        if segment is self.segments["code"]:
+            self._define_symbol(tokens[1], address)
         else:
-            self._error("syntax error")
+            self._define_symbol(tokens[1], len(segment.image))
+        return []
+
+    def _assemble_file(self, tokens, address):
+        self.file = tokens[1][1:-1]
+        return []
+
+    def _assemble_line_number(self, tokens, address):
+        self.line = int(tokens[1])
+        return []
 
+    def _assemble_nothing(self, tokens, address):
         return []
 
+    def _assemble_unknown(self, tokens, address):
+        self._error("syntax error")
+
     def _parse_expression(self, expr):
-        start = 0
-        last_op = None
+        # symbols can't change during the second pass, so expressions only need to
+        # be evaluated once there
+        if self.pass_number == 1:
+            key = (expr, self.current_file_index)
+            value = self.expression_cache.get(key)
+            if value is None:
+                value = self.expression_cache[key] = self._evaluate_expression(expr)
+            return value
+
+        return self._evaluate_expression(expr)
+
+    def _evaluate_expression(self, expr):
         value = 0
-        for i in range(len(expr) + 1):
-            if i == len(expr) or expr[i] == "+" or (expr[i] == "-" and i > 0):
-                end = i
-                sym = expr[start:end]
-                start = end + 1
-
-                if last_op == "+":
-                    value += int(sym)
-                elif last_op == "-":
-                    value -= int(sym)
-                else:
-                    if sym[0] in "+-0123456789":
-                        value = int(sym)
-                    else:
-                        value = self._lookup_symbol(sym)
-
-                if i < len(expr):
-                    last_op = expr[end]
+        for sign, term in expression_term_regex.findall(expr):
+            if term[0] in "0123456789":
+                term_value = int(term)
+            else:
+                term_value = self._lookup_symbol(term)
+
+            if sign == "-":
+                value -= term_value
+            else:
+                value += term_value
 
         return value
 
@@ -335,12 +363,12 @@ class Assembler:
         if self.pass_number == 1:
             return
 
+        if name[0] == "$":
+            name += self.local_symbol_suffix
+
         if name in self.symbols:
             self._error(f"multiple definitions for {name}")
 
-        if name.startswith("$"):
-            name += f"_{self.current_file_index}"
-
         self.symbols[name] = Symbol(self.current_segment, value)
         self.last_symbol = self.symbols[name]
 
@@ -348,21 +376,67 @@ class Assembler:
         if self.pass_number == 0:
             return 0
 
-        if name.startswith("$"):
-            name += f"_{self.current_file_index}"
+        if name[0] == "$":
+            name += self.local_symbol_suffix
 
-        if name not in self.symbols:
+        s = self.symbols.get(name)
+        if s is None:
             self._error(f"symbol {name} undefined")
 
-        s = self.symbols[name]
-        return s.segment.segment_base + s.value
+        if s.address is None:
+            s.address = s.segment.segment_base + s.value
+        return s.address
 
     def _hack_to_segment(self, segment):
-        if self.current_segment != segment:
+        if self.current_segment is not segment:
             self.current_segment = segment
             if self.pass_number == 0:
-                self.last_symbol.segment = self.current_segment
-                self.last_symbol.value = len(self.current_segment.image)
+                last_symbol = self.last_symbol
+                last_symbol.segment = segment
+                last_symbol.value = len(segment.image)
 
     def _error(self, message):
         raise AssemblerError(f"{self.file}:{self.line}: error; {message}")
+
+
+# maps the first token of a line to the Assembler method that handles it
+line_handlers = {name: Assembler._assemble_opcode for name in opcode_map}
+line_handlers.update(
+    {
+        "proc": Assembler._assemble_proc,
+        "endproc": Assembler._assemble_endproc,
+        "address": Assembler._assemble_address,
+        "code": Assembler._assemble_segment,
+        "data": Assembler._assemble_segment,
+        "lit": Assembler._assemble_segment,
+        "bss": Assembler._assemble_segment,
+        "equ": Assembler._assemble_equ,
+        "align": Assembler._assemble_align,
+        "skip": Assembler._assemble_skip,
+        "byte": Assembler._assemble_byte,
+        "file": Assembler._assemble_file,
+        "line": Assembler._assemble_line_number,
+        "import": Assembler._assemble_nothing,
+        "export": Assembler._assemble_nothing,
+    }
+)
+
+# mnemonics that carry a type suffix are matched by prefix the first time they're
+# seen and then added to line_handlers
+line_handler_prefixes = [
+    ("CALL", Assembler._assemble_call),
+    ("ARG", Assembler._assemble_arg),
+    ("RET", Assembler._assemble_ret),
+    ("pop", Assembler._assemble_pop),
+    ("ADDRF", Assembler._assemble_addrf),
+    ("ADDRL", Assembler._assemble_addrl),
+    ("LABEL", Assembler._assemble_label),
+]
+
+
+def find_line_handler(name):
+    for prefix, handler in line_handler_prefixes:
+        if name.startswith(prefix):
+            line_handlers[name] = handler
+            return handler
+    return Assembler._assemble_unknown
@@ -19,24 +19,59 @@
 
 from __future__ import annotations
 
+import array
 import collections
+import concurrent.futures
 import contextlib
+import functools
+import hashlib
+import itertools
 import mmap
 import os
+import pickle
+import re
 import struct
+import sys
 import tempfile
-from collections.abc import Iterable, Mapping
+from collections.abc import Iterable, Mapping, Sequence
 from typing import Optional, Union
 from ._compile import compile_c_file, CompilerError
-from ._instruction import assemble, disassemble, Instruction as Ins, Opcode as Op
-from ._memory import Memory, RegionTag
+from ._instruction import (
+    assemble,
+    decode,
+    encode,
+    encoded_size,
+    Instruction as Ins,
+    instructions_from_arrays,
+    Opcode as Op,
+    Operand,
+)
+from ._memory import Memory, Region, RegionTag
 from ._q3asm import Assembler, AssemblerError
-from ._util import crc32, forge_crc32, pad
+from ._util import align, crc32, forge_crc32, pad_in_place
 
 
 STACK_SIZE = 0x10000
-HEADER_FORMAT = "<IIIIIIII"
-HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER = struct.Struct("<IIIIIIII")
+
+# runs of at least this many identical non-zero DATA words are initialized with a
+# loop instead of one store per word
+FILL_LOOP_MIN_WORDS = 8
+
+# non-zero runs of at least this many DATA words that are identical to a run that was
+# already initialized are copied from it with BLOCK_COPY
+BLOCK_COPY_MIN_WORDS = 2
+
+# the opcode bytes of a CONST instruction followed by a CALL
+CONST_CALL = bytes((Op.CONST, Op.CALL))
+
+# an Instruction without an operand can't be modified, so the init code shares one
+# instance of each store instead of creating one per stored value
+_STORE1 = Ins(Op.STORE1)
+_STORE4 = Ins(Op.STORE4)
+
+# matches runs of non-zero bytes
+NON_ZERO_BYTES = re.compile(rb"[^\x00]+")
 
 
 class InitSymbolError(Exception):
@@ -53,10 +88,17 @@ class Qvm:
         LCC environment variable can be set to the path of a different lcc executable if
         a specific version is needed.
 
+    Caching disassembly:
+        Decoding the code section is the slowest part of loading a large .qvm. If the
+        QUATCH_DISASM_CACHE environment variable is set to a directory, decoded code is
+        stored there and reused the next time the same code is loaded. The cache files
+        are pickles, so only point this at a directory you trust.
+
     Attributes:
         vm_magic: The magic number of the qvm file format version.
         memory: The contents of the program's memory.
-        instructions: Dissasembly of the code section.
+        instructions: Dissasembly of the code section. This is only created the first
+            time it is accessed.
         symbols: A dictionary mapping symbol names to addresses.
     """
 
@@ -66,7 +108,11 @@ class Qvm:
         A mapping from names to addresses may be provided in symbols. Anything defined
         here will be available from C code added with self.add_c_code.
         """
-        with open(path, "rb") as f:
+        # map the file instead of reading it, so the sections can be sliced out of it
+        # and checksummed without first being copied into bytes objects
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped, memoryview(mapped) as view:
             (
                 self.vm_magic,
                 instruction_count,
@@ -76,13 +122,22 @@ class Qvm:
                 self._orignal_data_length,
                 self._original_lit_length,
                 bss_length,
-            ) = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
-
-            f.seek(code_offset)
-            self.instructions = disassemble(f.read(code_length))
-
-            # strip off trailing instructions that are actually just padding
-            self.instructions = self.instructions[:instruction_count]
+            ) = HEADER.unpack_from(view)
+
+            # the original code is kept as separate arrays of opcodes and operands
+            # until something asks for self.instructions, since creating an
+            # Instruction for every one of them is slow and often not needed
+            code = mapped[code_offset : code_offset + code_length]
+            # stop at instruction_count so trailing padding is never decoded
+            opcodes, operands = _decode_cached(code, instruction_count)
+            # until then, write() copies the original bytes and only re-encodes the
+            # CONST instructions that _set_call_target changed
+            self._code: Optional[bytes] = code[: encoded_size(opcodes)]
+            self._patched_calls: Optional[set[int]] = set()
+            self._opcodes: Optional[bytearray] = opcodes
+            self._operands: Optional[list[Optional[Operand]]] = operands
+            self._added_instructions: Optional[list[Ins]] = []
+            self._instructions: Optional[list[Ins]] = None
 
             self.memory = Memory()
 
@@ -91,21 +146,41 @@ class Qvm:
             # more bytes at the end when we're done.
             bss_length -= STACK_SIZE
 
-            f.seek(data_offset)
-            self.add_data(f.read(self._orignal_data_length))
-            self.add_lit(f.read(self._original_lit_length))
+            lit_offset = data_offset + self._orignal_data_length
+            lit_end = lit_offset + self._original_lit_length
+            # release the slices even on errors, or closing the map would fail
+            with view[data_offset:lit_offset] as data, view[lit_offset:lit_end] as lit:
+                self.add_data(data)
+                self.add_lit(lit)
             self.add_bss(bss_length)
 
-            f.seek(0)
-            self._original_crc = crc32(f.read())
+            self._original_crc = crc32(view)
 
         self.symbols = dict(symbols or {})
 
-        self._calls = collections.defaultdict(list)
-        for i in range(len(self.instructions) - 1):
-            first, second = self.instructions[i : i + 2]
-            if first.opcode == Op.CONST and second.opcode == Op.CALL:
-                self._calls[first.operand].append(i)
+        # maps call targets to arrays of indices of the CONST instructions before calls
+        # to them. This only covers the original code, and the keys are the original
+        # targets even after replace_calls, since _add_data_init_code relies on both.
+        self._calls = collections.defaultdict(functools.partial(array.array, "i"))
+        # opcodes is a bytearray with one byte per instruction, so CONST, CALL pairs
+        # can be found with a substring search instead of a Python loop
+        i = opcodes.find(CONST_CALL)
+        while i != -1:
+            self._calls[operands[i]].append(i)
+            i = opcodes.find(CONST_CALL, i + 2)
+
+    @property
+    def instructions(self) -> list[Ins]:
+        if self._instructions is None:
+            self._instructions = instructions_from_arrays(self._opcodes, self._operands)
+            self._instructions += self._added_instructions
+            self._drop_original_code()
+        return self._instructions
+
+    @instructions.setter
+    def instructions(self, instructions: list[Ins]) -> None:
+        self._instructions = instructions
+        self._drop_original_code()
 
     def write(self, path: str, forge_crc: bool = False) -> None:
         """Write a .qvm file.
@@ -115,50 +190,61 @@ class Qvm:
 
         New data will be initialized by hooking one of the G_InitGame, CG_Init, or
         UI_Init functions. An InitSymbolError exception will be raised if a valid symbol
-        for one of these functions cannot be found.
+        for one of these functions cannot be found. If all new data is zero, nothing
+        needs to be initialized and no hook is installed.
         """
         self._add_data_init_code()
 
-        with open(path, "w+b") as f:
-            f.seek(HEADER_SIZE)
+        # assemble the whole file in memory so it can be written out in one go
+        if self._instructions is None:
+            code = bytearray(self._code)
+            const = bytes((Op.CONST,))
+            offset = 0
+            previous = 0
+            for index in sorted(self._patched_calls):
+                offset += encoded_size(self._opcodes[previous:index])
+                previous = index
+                code[offset : offset + 5] = encode(const, (self._operands[index],))
+            code += assemble(self._added_instructions)
+        else:
+            code = assemble(self._instructions)
+        pad_in_place(code, 4)
+        code_offset = HEADER.size
+        data_offset = code_offset + len(code)
+
+        # copy memory straight into the image instead of slicing it first
+        data_length = self._orignal_data_length + self._original_lit_length
+        image = bytearray(data_offset + data_length)
+        image[code_offset:data_offset] = code
+        self.memory.copy_into(image, data_offset, 0, data_length)
+
+        bss_length = (
+            len(self.memory)
+            - self._orignal_data_length
+            - self._original_lit_length
+            + STACK_SIZE
+        )
 
-            code_offset = f.tell()
-            code = pad(assemble(self.instructions), 4)
-            f.write(code)
+        HEADER.pack_into(
+            image,
+            0,
+            self.vm_magic,
+            self._instruction_count(),
+            code_offset,
+            len(code),
+            data_offset,
+            self._orignal_data_length,
+            self._original_lit_length,
+            bss_length,
+        )
 
-            data_offset = f.tell()
-            f.write(
-                self.memory[: self._orignal_data_length + self._original_lit_length]
-            )
+        if forge_crc:
+            # we'll let forge_crc32 overwrite the first 4 bytes of the data section
+            # since nobody should be using address 0
+            forge_crc32(image, data_offset, self._original_crc)
 
-            bss_length = (
-                len(self.memory)
-                - self._orignal_data_length
-                - self._original_lit_length
-                + STACK_SIZE
-            )
-
-            f.seek(0)
-            f.write(
-                struct.pack(
-                    HEADER_FORMAT,
-                    self.vm_magic,
-                    len(self.instructions),
-                    code_offset,
-                    len(code),
-                    data_offset,
-                    self._orignal_data_length,
-                    self._original_lit_length,
-                    bss_length,
-                )
-            )
-
-            if forge_crc:
-                f.flush()
-                with mmap.mmap(f.fileno(), 0) as mm:
-                    # we'll let forge_crc32 overwrite the first 4 bytes of the data
-                    # section since nobody should be using address 0
-                    forge_crc32(mm, data_offset, self._original_crc)
+        with open(path, "wb") as f:
+            f.write(image)
 
     def add_data(self, data: bytes, alignment: int = 4) -> int:
         """Add data to the DATA section and return its address.
@@ -183,8 +269,11 @@ class Qvm:
 
     def add_code(self, instructions: Iterable[Ins]) -> int:
         """Add code to the Qvm and return its address."""
-        address = len(self.instructions)
-        self.instructions.extend(instructions)
+        address = self._instruction_count()
+        if self._instructions is None:
+            self._added_instructions.extend(instructions)
+        else:
+            self._instructions.extend(instructions)
         return address
 
     def add_c_code(
@@ -199,18 +288,12 @@ class Qvm:
 
         Returns the compiler's standard output/error.
         """
-        c_file = tempfile.NamedTemporaryFile(suffix=".c", delete=False)
-        try:
-            c_file.write(code.encode())
-
-            # this must be closed on windows or lcc won't be able to open it
-            c_file.close()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            c_path = os.path.join(temp_dir, "code.c")
+            with open(c_path, "wb") as c_file:
+                c_file.write(code.encode())
 
-            return self.add_c_file(c_file.name, include_dirs=include_dirs)
-        finally:
-            c_file.close()
-            with contextlib.suppress(FileNotFoundError):
-                os.remove(c_file.name)
+            return self.add_c_file(c_path, include_dirs=include_dirs)
 
     def add_c_file(
         self, path: str, include_dirs: Optional[Iterable[str]] = None
@@ -238,48 +321,72 @@ class Qvm:
 
         Returns the compiler's standard output/error.
         """
-        asm_files = []
-        output = ""
-
-        try:
-            for path in paths:
-                asm_file = tempfile.NamedTemporaryFile(suffix=".asm", delete=False)
-                asm_files.append(asm_file)
-
-                # this must be closed on windows or lcc won't be able to open it
-                asm_file.close()
-
-                output += compile_c_file(path, asm_file.name, include_dirs=include_dirs)
+        paths = list(paths)
+        if include_dirs is not None:
+            # every compile needs to see the include directories
+            include_dirs = list(include_dirs)
+
+        # everything lcc writes goes in a temporary directory that is removed as a
+        # whole afterwards, so the files never need to be opened or deleted here
+        with tempfile.TemporaryDirectory() as temp_dir:
+            asm_paths = [os.path.join(temp_dir, f"{i}.asm") for i in range(len(paths))]
+
+            # lcc does its work in child processes, so threads are enough to compile
+            # the files in parallel. map returns outputs and raises errors in order.
+            compile_file = functools.partial(compile_c_file, include_dirs=include_dirs)
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                output = "".join(executor.map(compile_file, paths, asm_paths))
 
             self.memory.align(4)
 
-            assembler = Assembler()
-            instructions, segments, symbols = assembler.assemble(
-                [asm_file.name for asm_file in asm_files],
-                code_base=len(self.instructions),
-                data_base=len(self.memory),
-                symbols=self.symbols,
-            )
-
-            self.instructions.extend(instructions)
-
-            self.add_data(segments["data"].image)
-            self.add_lit(segments["lit"].image)
-            self.add_bss(len(segments["bss"].image))
+            try:
+                assembler = Assembler()
+                instructions, segments, symbols = assembler.assemble(
+                    asm_paths,
+                    code_base=self._instruction_count(),
+                    data_base=len(self.memory),
+                    symbols=self.symbols,
+                )
+            except AssemblerError as e:
+                raise CompilerError(str(e)) from None
 
-            self.symbols.update(symbols)
-            return output
+        self.add_code(instructions)
 
-        except AssemblerError as e:
-            raise CompilerError(str(e)) from None
+        # the assembler is done with its images, so they don't need to be copied
+        self.memory.add_region(
+            RegionTag.DATA, data=segments["data"].image, alignment=4, copy=False
+        )
+        self.memory.add_region(RegionTag.LIT, data=segments["lit"].image, copy=False)
+        self.add_bss(len(segments["bss"].image))
 
-        finally:
-            for asm_file in asm_files:
-                asm_file.close()
-                with contextlib.suppress(FileNotFoundError):
-                    os.remove(asm_file.name)
+        self.symbols.update(symbols)
+        return output
 
     def _add_data_init_code(self) -> None:
+        # skip .qvm's data and lit sections, which are stored in the file. New data
+        # lives in what the engine sees as bss, so it starts out zeroed and regions
+        # that are entirely zero can be skipped too.
+        original_lit = (
+            self._orignal_data_length,
+            self._orignal_data_length + self._original_lit_length,
+        )
+        data_regions = [
+            region
+            for region in self.memory.regions_with_tag(RegionTag.DATA)
+            if (region.begin, region.end) != (0, self._orignal_data_length)
+            and region.contents.count(0) != region.size
+        ]
+        lit_regions = [
+            region
+            for region in self.memory.regions_with_tag(RegionTag.LIT)
+            if (region.begin, region.end) != original_lit
+            and region.contents.count(0) != region.size
+        ]
+
+        # no hook is needed at all if there is nothing to initialize
+        if not data_regions and not lit_regions:
+            return
+
         for init_name in ("G_InitGame", "CG_Init", "UI_Init"):
             original_init = self.symbols.get(init_name)
             if original_init is not None:
@@ -290,80 +397,131 @@ class Qvm:
                 "Cannot find a symbol for G_InitGame, CG_Init, or UI_Init"
             )
 
-        if len(self._calls[original_init]) == 0:
+        # use get so looking up a function that is never called doesn't add it
+        init_calls = self._calls.get(original_init)
+        if not init_calls:
             raise InitSymbolError(f"{init_name} is never called")
 
         # check original_init's first callsite in case it has already been hooked
-        original_init_call = self._calls[original_init][0]
-        current_init = self.instructions[original_init_call].operand
-
-        init_wrapper = self.add_code([Ins(Op.ENTER, 0x100)])
+        original_init_call = init_calls[0]
+        current_init = self._call_target(original_init_call)
+
+        # build the whole wrapper locally and add it in one go at the end
+        base = self._instruction_count()
+        init_code = [Ins(Op.ENTER, 0x100)]
+
+        # the original data and lit sections are loaded from the file before the init
+        # code runs, so anything in them can be copied with BLOCK_COPY. The first word
+        # of data is left out since write() may overwrite it to forge the CRC.
+        original_data = _SectionIndex(
+            self.memory.region_at(0) if self._orignal_data_length else None, skip=4
+        )
+        original_lit_index = _SectionIndex(
+            self.memory.region_at(original_lit[0])
+            if self._original_lit_length
+            else None
+        )
 
         # initialize new data
-        for region in self.memory.regions_with_tag(RegionTag.DATA):
-            begin, end = region.begin, region.end
-
-            # skip .qvm's data section
-            if (begin, end) == (0, self._orignal_data_length):
-                continue
-
-            for address in range(begin, end, 4):
-                value = struct.unpack("<I", self.memory[address : address + 4])[0]
-                if value != 0:
-                    self.add_code(
-                        [
+        # maps the contents of non-zero runs of words that have already been
+        # initialized to their addresses, so later identical runs can be copied
+        initialized: dict[bytes, int] = {}
+        # maps values to the addresses of words that are in runs too short to ever be
+        # copied from. Those can be stored later, grouped by value.
+        scattered: dict[int, list[int]] = collections.defaultdict(list)
+        for region in data_regions:
+            # read the words straight from the region instead of slicing self.memory
+            words = _words(region.contents)
+            index = 0
+            for non_zero, run in itertools.groupby(words, bool):
+                count = len(list(run))
+                if non_zero:
+                    address = region.begin + index * 4
+                    source = address
+                    if count >= BLOCK_COPY_MIN_WORDS:
+                        key = bytes(region.contents[index * 4 : (index + count) * 4])
+                        source = initialized.get(key)
+                        if source is None:
+                            # DATA is byte-swapped the same way in both places, so
+                            # only the original data section can be a source here
+                            source = original_data.find(key)
+                            if source is None:
+                                source = address
+                            initialized[key] = source
+
+                    if count < BLOCK_COPY_MIN_WORDS:
+                        for k in range(count):
+                            scattered[words[index + k]].append(address + k * 4)
+                    elif source != address:
+                        init_code += [
                             Ins(Op.CONST, address),
-                            Ins(Op.CONST, value),
-                            Ins(Op.STORE4),
+                            Ins(Op.CONST, source),
+                            Ins(Op.BLOCK_COPY, count * 4),
                         ]
-                    )
+                    else:
+                        init_code += _store_words(
+                            base + len(init_code), address, words[index : index + count]
+                        )
+                index += count
 
-        # initialize new lit
-        for region in self.memory.regions_with_tag(RegionTag.LIT):
-            begin, end = region.begin, region.end
+        # words with the same value at evenly spaced addresses, like a field in each
+        # element of an array of structs, can be stored with a loop
+        for value, addresses in scattered.items():
+            init_code += _store_value(base + len(init_code), value, addresses)
 
-            # skip .qvm's lit section
-            if (begin, end) == (
-                self._orignal_data_length,
-                self._orignal_data_length + self._original_lit_length,
-            ):
-                continue
-
-            for address in range(begin, end):
-                value = self.memory[address]
-                if value != 0:
-                    self.add_code(
-                        [
-                            Ins(Op.CONST, address),
-                            Ins(Op.CONST, value),
-                            Ins(Op.STORE1),
+        # initialize new lit
+        for region in lit_regions:
+            # read the bytes straight from the region instead of indexing self.memory,
+            # letting the regex engine skip over runs of zeros
+            for match in NON_ZERO_BYTES.finditer(region.contents):
+                start = region.begin + match.start()
+
+                # BLOCK_COPY has to copy whole, aligned words, so look for the words
+                # covering the run in the original lit section. Bytes around the run
+                # are copied too, which is fine as long as they are in this region.
+                begin = start & ~3
+                end = align(region.begin + match.end(), 4)
+                if begin >= region.begin and end <= region.end:
+                    window = region.contents[begin - region.begin : end - region.begin]
+                    source = original_lit_index.find(window)
+                    if source is not None:
+                        init_code += [
+                            Ins(Op.CONST, begin),
+                            Ins(Op.CONST, source),
+                            Ins(Op.BLOCK_COPY, end - begin),
                         ]
-                    )
-
-        self.add_code(
-            [
-                # call original init function
-                Ins(Op.LOCAL, 0x108),
-                Ins(Op.LOAD4),
-                Ins(Op.ARG, 0x8),
-                Ins(Op.LOCAL, 0x10C),
-                Ins(Op.LOAD4),
-                Ins(Op.ARG, 0xC),
-                Ins(Op.LOCAL, 0x110),
-                Ins(Op.LOAD4),
-                Ins(Op.ARG, 0x10),
-                Ins(Op.CONST, current_init),
-                Ins(Op.CALL),
-                Ins(Op.LEAVE, 0x100),
-                # dummy end proc so quake3e doesn't complain
-                Ins(Op.PUSH),
-                Ins(Op.LEAVE, 0x100),
-            ]
-        )
+                        continue
+
+                for address, value in enumerate(match.group(), start):
+                    init_code += [
+                        Ins(Op.CONST, address),
+                        Ins(Op.CONST, value),
+                        _STORE1,
+                    ]
+
+        init_code += [
+            # call original init function
+            Ins(Op.LOCAL, 0x108),
+            Ins(Op.LOAD4),
+            Ins(Op.ARG, 0x8),
+            Ins(Op.LOCAL, 0x10C),
+            Ins(Op.LOAD4),
+            Ins(Op.ARG, 0xC),
+            Ins(Op.LOCAL, 0x110),
+            Ins(Op.LOAD4),
+            Ins(Op.ARG, 0x10),
+            Ins(Op.CONST, current_init),
+            Ins(Op.CALL),
+            Ins(Op.LEAVE, 0x100),
+            # dummy end proc so quake3e doesn't complain
+            Ins(Op.PUSH),
+            Ins(Op.LEAVE, 0x100),
+        ]
+        init_wrapper = self.add_code(init_code)
 
         # only hook the first call site in case there are multiple (this should be the
         # one called from vmMain when the qvm is first loaded)
-        self.instructions[original_init_call].operand = init_wrapper
+        self._set_call_target(original_init_call, init_wrapper)
 
     def replace_calls(self, old: Union[str, int], new: Union[str, int]) -> int:
         """Replace calls to old with calls to new.
@@ -371,6 +529,9 @@ class Qvm:
         The old and new functions can be provided as addresses or names. If they are
         names they will be looked up in self.symbols.
 
+        Only calls in the original .qvm's code are replaced. Calls in added code are
+        left alone so that a hook can still call the function it replaces.
+
         Returns the number of calls replaced.
         """
         if isinstance(old, str):
@@ -379,7 +540,245 @@ class Qvm:
         if isinstance(new, str):
             new = self.symbols[new]
 
-        for call in self._calls[old]:
-            self.instructions[call].operand = new
+        calls = self._calls.get(old, ())
+        for call in calls:
+            self._set_call_target(call, new)
+
+        return len(calls)
+
+    def _drop_original_code(self) -> None:
+        self._code = self._patched_calls = None
+        self._opcodes = self._operands = self._added_instructions = None
+
+    def _instruction_count(self) -> int:
+        if self._instructions is None:
+            return len(self._opcodes) + len(self._added_instructions)
+        return len(self._instructions)
+
+    def _call_target(self, index: int) -> Operand:
+        """Return the operand of the CONST instruction at index in the original code."""
+        if self._instructions is None:
+            return self._operands[index]
+        return self._instructions[index].operand
+
+    def _set_call_target(self, index: int, target: Operand) -> None:
+        """Set the operand of the CONST instruction at index in the original code."""
+        if self._instructions is None:
+            # go through Instruction so the operand gets validated
+            self._operands[index] = Ins(Op.CONST, target).operand
+            self._patched_calls.add(index)
+        else:
+            self._instructions[index].operand = target
+
+
+def _decode_cached(
+    code: bytes, count: int
+) -> tuple[bytearray, list[Optional[Operand]]]:
+    """Return decode(code, count), using the QUATCH_DISASM_CACHE directory if set.
 
-        return len(self._calls[old])
+    The cache is only an optimization, so unreadable entries are treated as misses
+    and failing to write one is ignored.
+    """
+    cache_dir = os.environ.get("QUATCH_DISASM_CACHE")
+    if not cache_dir:
+        return decode(code, count)
+
+    # key on the code itself so a cache entry can never be stale
+    digest = hashlib.sha1(code).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{digest}-{count}.pickle")
+
+    cached = _load_cache_entry(cache_path)
+    if cached is not None:
+        return cached
+
+    opcodes, operands = decode(code, count)
+    _store_cache_entry(cache_dir, cache_path, (opcodes, operands))
+    return opcodes, operands
+
+
+def _load_cache_entry(
+    cache_path: str,
+) -> Optional[tuple[bytearray, list[Optional[Operand]]]]:
+    """Return the decoded code stored at cache_path, or None if it can't be used."""
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+    except Exception:
+        # unpickling junk can raise almost anything, including OverflowError and
+        # MemoryError. Content of the wrong shape is rejected below.
+        return None
+
+    if (
+        isinstance(cached, tuple)
+        and len(cached) == 2
+        and isinstance(cached[0], bytearray)
+        and isinstance(cached[1], list)
+        and len(cached[0]) == len(cached[1])
+    ):
+        return cached
+    return None
+
+
+def _store_cache_entry(
+    cache_dir: str,
+    cache_path: str,
+    decoded: tuple[bytearray, list[Optional[Operand]]],
+) -> None:
+    # write to a temporary file first so nobody can load a partially written entry
+    temp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+            temp_path = f.name
+            pickle.dump(decoded, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        if temp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+
+
+class _SectionIndex:
+    """Finds 4-byte aligned copies of byte strings in one of the original sections.
+
+    The section's 8-byte aligned windows are put in a dict the first time it is
+    searched, so a search is a couple of lookups and comparisons instead of a scan of
+    the whole section.
+    """
+
+    __slots__ = ("_region", "_skip", "_windows")
+
+    def __init__(self, region: Optional[Region], skip: int = 0) -> None:
+        """Index region, ignoring its first skip bytes. region may be None."""
+        self._region = region
+        self._skip = skip
+        self._windows: Optional[dict[int, int]] = None
+
+    def find(self, sub: bytes) -> Optional[int]:
+        """Return a 4-byte aligned address where sub appears in the section, or None.
+
+        Only windows at 8-byte aligned addresses are indexed, so 8-byte strings are
+        only found at those, and shorter strings are never found.
+        """
+        region = self._region
+        if region is None or len(sub) < 8:
+            return None
+
+        if self._windows is None:
+            self._windows = self._index()
+
+        # a copy at an address that is 4 but not 8-byte aligned has its second word
+        # at an indexed window
+        for skipped in (0, 4) if len(sub) >= 12 else (0,):
+            key = int.from_bytes(sub[skipped : skipped + 8], sys.byteorder)
+            address = self._windows.get(key)
+            if address is not None:
+                offset = address - skipped - region.begin
+                if offset >= self._skip and (
+                    region.contents[offset : offset + len(sub)] == sub
+                ):
+                    return address - skipped
+        return None
+
+    def _index(self) -> dict[int, int]:
+        region = self._region
+        start = align(region.begin + self._skip, 8) - region.begin
+        end = start + max(0, region.size - start) // 8 * 8
+
+        # read the windows as 8-byte integers so the dict is built without a Python
+        # loop. Each window is kept at only one of its addresses.
+        with memoryview(region.contents) as view:
+            with view[start:end] as part, part.cast("Q") as keys:
+                addresses = range(region.begin + start, region.begin + end, 8)
+                return dict(zip(keys, addresses))
+
+
+def _words(data: bytearray) -> Sequence[int]:
+    """Return the little-endian 32-bit words in data.
+
+    On little-endian hosts this is a view of data rather than a copy.
+    """
+    if sys.byteorder == "little":
+        return memoryview(data).cast("I")
+    words = array.array("I", data)
+    words.byteswap()
+    return words
+
+
+def _store_words(start: int, address: int, words: Iterable[int]) -> list[Ins]:
+    """Return code that stores words beginning at address.
+
+    Runs of identical words are stored with a loop if they are long enough. start is
+    the index the code will be placed at.
+    """
+    code = []
+    for value, run in itertools.groupby(words):
+        count = len(list(run))
+        if count >= FILL_LOOP_MIN_WORDS:
+            code += _fill_loop(start + len(code), address, value, count)
+        else:
+            for word_address in range(address, address + count * 4, 4):
+                code += [Ins(Op.CONST, word_address), Ins(Op.CONST, value), _STORE4]
+        address += count * 4
+    return code
+
+
+def _store_value(start: int, value: int, addresses: Sequence[int]) -> list[Ins]:
+    """Return code that stores value at each of the sorted addresses.
+
+    Evenly spaced addresses are stored with a loop if there are enough of them. start
+    is the index the code will be placed at.
+    """
+    code = []
+    i = 0
+    while i < len(addresses):
+        # find the longest evenly spaced run beginning at addresses[i]
+        j = i + 1
+        if j < len(addresses):
+            stride = addresses[j] - addresses[i]
+            while j < len(addresses) and addresses[j] - addresses[j - 1] == stride:
+                j += 1
+
+        if j - i >= FILL_LOOP_MIN_WORDS:
+            code += _fill_loop(start + len(code), addresses[i], value, j - i, stride)
+            i = j
+        else:
+            # a run could still begin at the next address
+            code += [Ins(Op.CONST, addresses[i]), Ins(Op.CONST, value), _STORE4]
+            i += 1
+    return code
+
+
+def _fill_loop(
+    start: int, address: int, value: int, count: int, stride: int = 4
+) -> list[Ins]:
+    """Return code that stores value to count words beginning at address, stride
+    bytes apart.
+
+    The code expects to be placed at instruction start inside a function whose frame
+    is at least 0x100 bytes, and uses the last word of the frame as a pointer.
+    """
+    pointer = 0xFC
+    head = start + 3
+    return [
+        Ins(Op.LOCAL, pointer),
+        Ins(Op.CONST, address),
+        _STORE4,
+        # head: store value at the pointer
+        Ins(Op.LOCAL, pointer),
+        Ins(Op.LOAD4),
+        Ins(Op.CONST, value),
+        _STORE4,
+        # advance the pointer to the next word
+        Ins(Op.LOCAL, pointer),
+        Ins(Op.LOCAL, pointer),
+        Ins(Op.LOAD4),
+        Ins(Op.CONST, stride),
+        Ins(Op.ADD),
+        _STORE4,
+        # loop until the pointer reaches the end of the run
+        Ins(Op.LOCAL, pointer),
+        Ins(Op.LOAD4),
+        Ins(Op.CONST, address + count * stride),
+        Ins(Op.LTU, head),
+    ]
@@ -22,8 +22,11 @@ def align(n, alignment):
     return n + (alignment - (n % alignment)) % alignment
 
 
-def pad(data, alignment, padding=b"\0"):
-    return data + padding * (align(len(data), alignment) - len(data))
+def pad_in_place(data, alignment):
+    """Extend the bytearray data with zeros until its length is a multiple of
+    alignment.
+    """
+    data.extend(bytes(align(len(data), alignment) - len(data)))
 
 
 def crc32(data):
@@ -40,21 +43,44 @@ def forge_crc32(data, offset, crc):
     def pack(x):
         return x.to_bytes(4, "little")
 
-    data[offset : offset + 4] = pack(crc32(data[:offset]) ^ 0xFFFFFFFF)
-    data[offset : offset + 4] = pack(_crc32_reverse(data[offset:], crc))
+    # use views so the checksums don't need to copy the data
+    with memoryview(data) as view:
+        data[offset : offset + 4] = pack(crc32(view[:offset]) ^ 0xFFFFFFFF)
+        data[offset : offset + 4] = pack(_crc32_reverse(view[offset:], crc))
 
 
 def _crc32_reverse(data, crc):
     """Return the state the crc register would need to be in just before processing
     data in order to produce the desired checksum.
     """
-    reg = crc ^ 0xFFFFFFFF
-    for byte in reversed(data):
-        reg = (reg << 8) ^ _crc32_reverse_table[reg >> 24] ^ byte
-        reg &= 0xFFFFFFFF
+    # the crc register is affine in its starting state: running it over data from
+    # state s gives the result of running it over len(data) zeros from s, xor'd with
+    # the result of running it over data from zero. binascii handles the second part
+    # in C, which leaves undoing len(data) zero bytes.
+    reg = crc ^ binascii.crc32(data, 0xFFFFFFFF)
+
+    # apply the inverse of the zero byte step len(data) times, by squaring
+    matrix = _crc32_reverse_matrix
+    count = len(data)
+    while count:
+        if count & 1:
+            reg = _gf2_matrix_times(matrix, reg)
+        count >>= 1
+        if count:
+            matrix = [_gf2_matrix_times(matrix, column) for column in matrix]
     return reg
 
 
+def _gf2_matrix_times(matrix, vector):
+    """Multiply a 32x32 matrix over GF(2), given as a list of columns, by a vector."""
+    result = 0
+    for column in matrix:
+        if vector & 1:
+            result ^= column
+        vector >>= 1
+    return result
+
+
 def _gen_crc32_reverse_table():
     table = []
     for i in range(256):
@@ -68,4 +94,14 @@ def _gen_crc32_reverse_table():
     return table
 
 
+def _gen_crc32_reverse_matrix():
+    """Return the matrix for stepping the crc register backwards over a zero byte."""
+    matrix = []
+    for i in range(32):
+        reg = 1 << i
+        matrix.append(((reg << 8) ^ _crc32_reverse_table[reg >> 24]) & 0xFFFFFFFF)
+    return matrix
+
+
 _crc32_reverse_table = _gen_crc32_reverse_table()
+_crc32_reverse_matrix = _gen_crc32_reverse_matrix()
@@ -72,6 +72,28 @@ class TestMemory(unittest.TestCase):
                 self.reference[i:j] = data
                 self.assertEqual(self.reference[i:j], self.memory[i:j])
 
+    def test_copy_into(self):
+        size = len(self.reference)
+
+        for i in range(size + 1):
+            for j in range(size + 1):
+                buffer = bytearray(size + 2)
+                self.memory.copy_into(buffer, 1, i, j)
+                expected = bytearray(size + 2)
+                if i < j:
+                    expected[1 : 1 + j - i] = self.reference[i:j]
+                self.assertEqual(buffer, expected)
+
+    def test_add_region_copy(self):
+        data = bytearray(b"abcd")
+
+        address = self.memory.add_region(RegionTag.LIT, data=data)
+        data[0] = ord("x")
+        self.assertEqual(self.memory[address : address + 4], b"abcd")
+
+        address = self.memory.add_region(RegionTag.LIT, data=data, copy=False)
+        self.assertIs(self.memory.region_at(address).contents, data)
+
 
 if __name__ == "__main__":
     unittest.main()
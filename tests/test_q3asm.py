@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+from quatch import Instruction as Ins, Opcode as Op
+from quatch._q3asm import Assembler, AssemblerError
+
+LOCAL_LABEL_ASM = """\
+code
+proc {name} 0 0
+LABELV $1
+ADDRGP4 $1
+endproc {name} 0 0
+"""
+
+
+class TestAssembler(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+
+    def assemble(self, *sources, **kwargs):
+        paths = []
+        for i, source in enumerate(sources):
+            path = os.path.join(self.temp_dir, f"{i}.asm")
+            with open(path, "w") as f:
+                f.write(source)
+            paths.append(path)
+        return Assembler().assemble(paths, **kwargs)
+
+    def test_local_labels_are_per_file(self):
+        instructions, _, symbols = self.assemble(
+            LOCAL_LABEL_ASM.format(name="f"),
+            LOCAL_LABEL_ASM.format(name="g"),
+            code_base=100,
+        )
+        self.assertEqual(symbols["$1_0"], 101)
+        self.assertEqual(symbols["$1_1"], 105)
+        # each file's $1 refers to its own label
+        self.assertEqual(instructions[1].operand, 101)
+        self.assertEqual(instructions[5].operand, 105)
+
+    def test_duplicate_local_label(self):
+        source = LOCAL_LABEL_ASM.format(name="f") + "LABELV $1\n"
+        with self.assertRaisesRegex(AssemblerError, r"multiple definitions for \$1"):
+            self.assemble(source)
+
+    def test_expressions(self):
+        instructions, _, _ = self.assemble(
+            "code\n"
+            "proc f 0 0\n"
+            "ADDRGP4 sym+4\n"
+            "ADDRGP4 sym-4\n"
+            "CNSTI4 -8\n"
+            "ADDRGP4 ext+sym-12\n"
+            "endproc f 0 0\n"
+            "data\n"
+            "align 4\n"
+            "LABELV sym\n"
+            "byte 4 1\n",
+            data_base=0x1000,
+            symbols={"ext": 5},
+        )
+        self.assertEqual(
+            [instruction.operand for instruction in instructions[1:5]],
+            [0x1004, 0xFFC, -8, 0xFF9],
+        )
+
+    def test_suffixed_mnemonics(self):
+        instructions, _, _ = self.assemble(
+            "code\n"
+            "proc f 4 8\n"
+            "ADDRLP4 0\n"
+            "ARGP4\n"
+            "ADDRFP4 4\n"
+            "ARGI4\n"
+            "ADDRGP4 f\n"
+            "CALLI4\n"
+            "RETI4\n"
+            "endproc f 4 8\n"
+        )
+        expected = [
+            Ins(Op.ENTER, 20),
+            Ins(Op.LOCAL, 16),
+            Ins(Op.ARG, 8),
+            Ins(Op.LOCAL, 32),
+            Ins(Op.ARG, 12),
+            Ins(Op.CONST, 0),
+            Ins(Op.CALL),
+            Ins(Op.LEAVE, 20),
+            Ins(Op.PUSH),
+            Ins(Op.LEAVE, 20),
+        ]
+        self.assertEqual([str(i) for i in instructions], [str(i) for i in expected])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,313 @@
+import os
+import random
+import struct
+import tempfile
+import unittest
+from unittest import mock
+from quatch import assemble, InitSymbolError, Instruction as Ins, Opcode as Op, Qvm
+
+
+VM_MAGIC = 0x12721444
+STACK_SIZE = 0x10000
+
+# vmMain calls G_InitGame, which is the instruction at index 4
+G_INIT_GAME = 4
+CODE = [
+    Ins(Op.ENTER, 0x10),
+    Ins(Op.CONST, G_INIT_GAME),
+    Ins(Op.CALL),
+    Ins(Op.LEAVE, 0x10),
+    Ins(Op.ENTER, 0x10),
+    Ins(Op.LEAVE, 0x10),
+]
+
+
+def write_qvm(path, data=b"", lit=b""):
+    code = assemble(CODE)
+    code += bytes(-len(code) % 4)
+    header = struct.pack(
+        "<IIIIIIII",
+        VM_MAGIC,
+        len(CODE),
+        32,
+        len(code),
+        32 + len(code),
+        len(data),
+        len(lit),
+        STACK_SIZE,
+    )
+    with open(path, "wb") as f:
+        f.write(header + code + data + lit)
+
+
+def run_init_code(path):
+    """Run the data init code in the .qvm at path until it calls the original init
+    function. Returns the resulting memory, the instructions, and the index the init
+    code starts at.
+
+    Only the instructions the init code uses are supported.
+    """
+    with open(path, "rb") as f:
+        header = struct.unpack("<IIIIIIII", f.read(32))
+        f.seek(header[4])
+        memory = bytearray(f.read(header[5] + header[6]))
+    memory += bytes(header[7])
+
+    instructions = Qvm(path).instructions
+    pc = start = instructions[1].operand
+    stack = []
+    frame = len(memory)
+
+    def load4(address):
+        return int.from_bytes(memory[address : address + 4], "little")
+
+    while True:
+        instruction = instructions[pc]
+        op = instruction.opcode
+        pc += 1
+        if op is Op.ENTER:
+            frame -= instruction.operand
+        elif op is Op.CONST:
+            stack.append(instruction.operand)
+        elif op is Op.LOCAL:
+            stack.append(frame + instruction.operand)
+        elif op is Op.LOAD4:
+            stack.append(load4(stack.pop()))
+        elif op is Op.STORE4:
+            value, address = stack.pop(), stack.pop()
+            memory[address : address + 4] = value.to_bytes(4, "little")
+        elif op is Op.STORE1:
+            value, address = stack.pop(), stack.pop()
+            memory[address] = value & 0xFF
+        elif op is Op.ADD:
+            b, a = stack.pop(), stack.pop()
+            stack.append((a + b) & 0xFFFFFFFF)
+        elif op is Op.LTU:
+            b, a = stack.pop(), stack.pop()
+            if a < b:
+                pc = instruction.operand
+        elif op is Op.BLOCK_COPY:
+            # some engines copy size / 4 words, so everything has to be aligned
+            source, dest, size = stack.pop(), stack.pop(), instruction.operand
+            assert size % 4 == 0 and source % 4 == 0 and dest % 4 == 0
+            memory[dest : dest + size] = memory[source : source + size]
+        elif op is Op.ARG:
+            value = stack.pop()
+            memory[frame + instruction.operand :][:4] = value.to_bytes(4, "little")
+        elif op is Op.CALL:
+            assert stack.pop() == G_INIT_GAME
+            return memory, instructions, start
+        else:
+            raise NotImplementedError(op)
+
+
+def words(*values):
+    return struct.pack(f"<{len(values)}I", *values)
+
+
+class TestDataInitCode(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        path = os.path.join(self.temp_dir, "test.qvm")
+        write_qvm(path, data=words(1, 2, 3, 4), lit=b"original\0more\0\0\0")
+        self.qvm = Qvm(path, symbols={"G_InitGame": G_INIT_GAME})
+
+    def run_init(self):
+        """Write self.qvm, check that its init code produces self.qvm.memory, and
+        return the instructions and the index the init code starts at.
+        """
+        path = os.path.join(self.temp_dir, "out.qvm")
+        self.qvm.write(path)
+        memory, instructions, start = run_init_code(path)
+        self.assertEqual(memory[: len(self.qvm.memory)], self.qvm.memory[:])
+        return instructions, start
+
+    def copies(self):
+        """Run the init code and return the (dest, source, size) of each BLOCK_COPY."""
+        instructions, start = self.run_init()
+        return [
+            tuple(instruction.operand for instruction in instructions[i - 2 : i + 1])
+            for i in range(start, len(instructions))
+            if instructions[i].opcode is Op.BLOCK_COPY
+        ]
+
+    def find_loop(self, address):
+        """Return the fill loop that begins storing at address, checking its jump."""
+        instructions, start = self.run_init()
+        for i in range(start, len(instructions)):
+            if (
+                instructions[i].opcode is Op.LTU
+                and instructions[i - 15].opcode is Op.CONST
+                and instructions[i - 15].operand == address
+            ):
+                # the loop jumps back to just after the pointer is initialized
+                self.assertEqual(instructions[i].operand, i - 13)
+                return instructions[i - 16 : i + 1]
+        self.fail(f"no fill loop for {address:#x}")
+
+    def test_contiguous_fill_loop(self):
+        address = self.qvm.add_data(words(*[7] * 20))
+        loop = self.find_loop(address)
+        self.assertEqual(loop[10].operand, 4)
+        self.assertEqual(loop[15].operand, address + 20 * 4)
+
+    def test_strided_fill_loop(self):
+        # the first field of an array of 12 three-word structs
+        address = self.qvm.add_data(words(*[5, 0, 0] * 12))
+        loop = self.find_loop(address)
+        self.assertEqual(loop[10].operand, 12)
+        self.assertEqual(loop[15].operand, address + 12 * 12)
+
+    def test_repeated_run_is_copied(self):
+        # scattered words around the runs are stored after everything else, so the
+        # copy relies on the first run having been stored in place
+        a, b = 0x11111111, 0x22222222
+        address = self.qvm.add_data(words(9, 0, a, b, 0, 9, 0, 0, a, b, 0, 9))
+        self.assertEqual(self.copies(), [(address + 8 * 4, address + 2 * 4, 8)])
+
+    def test_data_copied_from_original_data(self):
+        # words 3, 4 are at the 8-byte aligned address 8
+        address = self.qvm.add_data(words(3, 4))
+        self.assertEqual(self.copies(), [(address, 8, 8)])
+
+    def test_data_copied_from_unaligned_original_data(self):
+        # words 2, 3, 4 are at address 4, which is found through their second word
+        address = self.qvm.add_data(words(2, 3, 4))
+        self.assertEqual(self.copies(), [(address, 4, 12)])
+
+    def test_data_not_copied_from_address_zero(self):
+        # forge_crc may overwrite the word at address 0, so it is never a source
+        self.qvm.add_data(words(1, 2))
+        self.qvm.add_data(words(1, 2, 3, 4))
+        self.assertEqual(self.copies(), [])
+
+    def test_lit_copied_from_original_lit(self):
+        # "more" is widened to the aligned word pair "\0more\0\0\0" at address 24
+        address = self.qvm.add_lit(b"\0more\0\0\0", alignment=8)
+        self.assertEqual(self.copies(), [(address, 24, 8)])
+
+    def test_random_data(self):
+        rng = random.Random(0)
+        for _ in range(20):
+            values = [rng.choice([0, 0, 0, 1, 2, 0xFFFFFFFF]) for _ in range(50)]
+            self.qvm.add_data(words(*values))
+            self.qvm.add_lit(bytes(rng.choice([0, 0, 65, 66]) for _ in range(23)))
+        self.run_init()
+
+
+class TestWrite(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.path = os.path.join(self.temp_dir, "test.qvm")
+        write_qvm(self.path, data=words(1, 2, 3, 4), lit=b"original\0")
+
+    def patch(self, name, touch):
+        """Apply the same patch, accessing qvm.instructions at the point named by
+        touch, and return the written file's contents.
+        """
+        qvm = Qvm(self.path, symbols={"G_InitGame": G_INIT_GAME})
+        if touch == "before add_code":
+            qvm.instructions
+        hook = qvm.add_code([Ins(Op.ENTER, 0x10), Ins(Op.LEAVE, 0x10)])
+        qvm.add_data(words(5, 6, 7, 0, 8))
+        qvm.add_lit(b"hook\0")
+        qvm.replace_calls("G_InitGame", hook)
+        if touch == "after replace_calls":
+            qvm.instructions
+
+        path = os.path.join(self.temp_dir, f"{name}.qvm")
+        qvm.write(path)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_original_code_passes_through(self):
+        # without touching qvm.instructions, write() copies the original code and
+        # re-encodes only the patched CONSTs, which has to match assembling it all
+        expected = self.patch("untouched", None)
+        for touch in ("before add_code", "after replace_calls"):
+            with self.subTest(touch=touch):
+                self.assertEqual(self.patch(touch.replace(" ", "_"), touch), expected)
+
+    def test_zero_data_needs_no_init_symbol(self):
+        # added data that is all zero is left to bss, so no hook is installed
+        qvm = Qvm(self.path)
+        added = [Ins(Op.ENTER, 0x10), Ins(Op.LEAVE, 0x10)]
+        qvm.add_code(added)
+        qvm.add_data(bytes(12))
+        qvm.add_lit(bytes(5))
+
+        path = os.path.join(self.temp_dir, "zero.qvm")
+        qvm.write(path)
+        with open(path, "rb") as f:
+            header = struct.unpack("<IIIIIIII", f.read(32))
+            f.seek(header[2])
+            code = f.read(header[3])
+        self.assertEqual(header[1], len(CODE) + len(added))
+        expected = assemble(CODE + added)
+        self.assertEqual(code, expected + bytes(-len(expected) % 4))
+
+        qvm.add_data(words(1))
+        with self.assertRaises(InitSymbolError):
+            qvm.write(path)
+
+
+class TestDisassemblyCache(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, "test.qvm")
+        self.cache_dir = os.path.join(temp_dir.name, "cache")
+        write_qvm(self.path, data=bytes(range(16)))
+
+    def load(self):
+        with mock.patch.dict(os.environ, {"QUATCH_DISASM_CACHE": self.cache_dir}):
+            return Qvm(self.path)
+
+    def assert_loaded(self, qvm):
+        self.assertEqual([str(i) for i in qvm.instructions], [str(i) for i in CODE])
+
+    def test_cache_is_used(self):
+        self.assert_loaded(self.load())
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assert_loaded(self.load())
+
+    def test_corrupt_entry(self):
+        self.load()
+        (entry,) = os.listdir(self.cache_dir)
+        junk_entries = (
+            b"",
+            b"junk",
+            b"\x80\x04\x95",
+            # a huge BINBYTES8 length, which raises OverflowError
+            b"\x80\x04\x8e" + b"\xff" * 8,
+            # a valid pickle of the wrong shape
+            b"\x80\x04K\x01.",
+        )
+        for junk in junk_entries:
+            with open(os.path.join(self.cache_dir, entry), "wb") as f:
+                f.write(junk)
+            self.assert_loaded(self.load())
+
+    def test_unusable_directory(self):
+        # a file where the cache directory should be
+        with open(self.cache_dir, "wb"):
+            pass
+        self.assert_loaded(self.load())
+
+    def test_failed_write_is_cleaned_up(self):
+        self.load()
+        (entry,) = os.listdir(self.cache_dir)
+
+        # a directory in place of the entry makes replacing it fail
+        os.remove(os.path.join(self.cache_dir, entry))
+        os.mkdir(os.path.join(self.cache_dir, entry))
+        self.assert_loaded(self.load())
+        self.assertEqual(os.listdir(self.cache_dir), [entry])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import random
+import unittest
+from quatch._util import crc32, forge_crc32
+
+
+class TestForgeCrc32(unittest.TestCase):
+    def test_forge_crc32(self):
+        rng = random.Random(0)
+
+        for size in (4, 5, 8, 100, 4099):
+            for offset in {0, size // 2 - size // 2 % 4, size - 4}:
+                data = bytearray(rng.getrandbits(8) for _ in range(size))
+                original = bytes(data)
+                crc = rng.getrandbits(32)
+
+                forge_crc32(data, offset, crc)
+
+                self.assertEqual(crc32(data), crc)
+                self.assertEqual(data[:offset], original[:offset])
+                self.assertEqual(data[offset + 4 :], original[offset + 4 :])
+
+
+if __name__ == "__main__":
+    unittest.main()